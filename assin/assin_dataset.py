@@ -2,24 +2,27 @@
 Definitions and tests managing the ASSIN dataset.
 '''
 import os
+import math
+import inspect
 import pickle
 import random
 import logging
 from collections import Counter
+from multiprocessing import cpu_count
 
 import xmltodict
 import numpy as np
 import torch
 import sentencepiece as spm
 from matplotlib import pyplot as plt
-from torch.utils.data import Dataset, DataLoader
-from transformers import T5Tokenizer
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 
 
 def prepare_data(file_name):
     '''
     Performs everything needed to get the data ready.
-    Addition of Eos token and encoding is performed in runtime.
+    Addition of Eos token and encoding is performed by the ASSIN dataset.
     '''
     folder = "assin_data"
     valid_modes = ["train", "validation", "test"]
@@ -61,8 +64,63 @@ def get_custom_vocab():
     sp = spm.SentencePieceProcessor()
     sp.load(SP_MODEL_PATH)
 
-    # Loading o HuggingFace
-    return T5Tokenizer.from_pretrained(SP_MODEL_PATH)
+    # Loading o HuggingFace, converted to the Rust backed fast tokenizer
+    from transformers import T5TokenizerFast
+    return T5TokenizerFast(vocab_file=SP_MODEL_PATH)
+
+
+def get_tokenizer(vocab_name):
+    '''
+    Fast tokenizer for vocab_name, "custom" being our Portuguese vocabulary.
+    transformers is imported here, dataloader workers only slice tensors and never need it.
+    '''
+    if vocab_name == "custom":
+        return get_custom_vocab()
+    else:
+        from transformers import T5TokenizerFast
+        return T5TokenizerFast.from_pretrained(vocab_name)
+
+
+def trim_collate(batch):
+    '''
+    Collates a batch and removes padding columns not used by any example in it.
+    '''
+    input_ids, attention_mask, target, original_number = default_collate(batch)
+    max_len = int(attention_mask.sum(dim=1).max())
+
+    return input_ids[:, :max_len], attention_mask[:, :max_len], target, original_number
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batches examples of similar length together, to reduce padding.
+    Indexes are split in buckets of bucket_size batches, each bucket is sorted by length and split in batches.
+    When shuffling, indexes are shuffled before bucketing and batch order is shuffled afterwards.
+    '''
+    def __init__(self, lengths, batch_size, shuffle, bucket_size=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indexes = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indexes)
+
+        batches = []
+        bucket_len = self.batch_size * self.bucket_size
+        for start in range(0, len(indexes), bucket_len):
+            bucket = sorted(indexes[start:start + bucket_len], key=lambda i: self.lengths[i])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            random.shuffle(batches)
+
+        return iter(batches)
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
 
 
 class ASSIN(Dataset):
@@ -71,7 +129,7 @@ class ASSIN(Dataset):
     '''
     CLASSES = ["None", "Entailment", "Paraphrase"]
     CLASSESv2 = ["None", "Entailment"]
-    TOKENIZER = None
+    CACHE_FORMAT = 2  # bump when tokenization changes, invalidating cached tokenized data
     DATA, VALID_MODES = prepare_data("processed_data.pkl")
 
     def __init__(self, version, mode, seq_len, vocab_name, categoric=False):
@@ -82,11 +140,6 @@ class ASSIN(Dataset):
         vocab_name: name of the vocabulary
         str_output: wether train will operate in string generation mode or not
         '''
-        if vocab_name == "custom":
-            ASSIN.TOKENIZER = get_custom_vocab()
-        else:
-            ASSIN.TOKENIZER = T5Tokenizer.from_pretrained(vocab_name)
-
         super().__init__()
         assert mode in ASSIN.VALID_MODES
 
@@ -95,48 +148,85 @@ class ASSIN(Dataset):
         self.categoric = categoric
         self.version = version
 
-        logging.info(f"{mode} ASSINv{version} initialized with categoric: {categoric}, seq_len: {seq_len}")
+        # Tokenization is fixed for a given configuration, so it is done only once and cached
+        task = "categoric" if categoric else "similarity"
+        cache_path = os.path.join("assin_data",
+                                  (f"tokenized_f{ASSIN.CACHE_FORMAT}_{version}_{mode}_{seq_len}_"
+                                   f"{vocab_name.replace('/', '_')}_{task}.pt"))
+        if os.path.isfile(cache_path):
+            logging.info(f"Tokenized data found in {cache_path}.")
+            self.tensors = torch.load(cache_path)
+        else:
+            logging.info("Tokenizing data...")
+            # The tokenizer is only loaded here and not kept, dataloader workers only receive tensors
+            self.tensors = self.tokenize(get_tokenizer(vocab_name))
+            torch.save(self.tensors, cache_path)
+            logging.info(f"Done. Saved to {cache_path}.")
 
-    def __len__(self):
-        return len(self.data)
+        logging.info(f"{mode} ASSINv{version} initialized with categoric: {categoric}, seq_len: {seq_len}")
 
-    def __getitem__(self, i: int):
+    def tokenize(self, tokenizer):
         '''
-        Unpacks line from data and applies T5 encoding if necessary.
+        Applies T5 encoding to the whole split at once.
 
-        returns: input_ids, attention_mask, target (encoded if training)
+        returns: input_ids, attention_mask, target (encoded) and original_number tensors for all examples
         '''
-        data = self.data[i]
-        pair = data["pair"]
-        eos_token = ASSIN.TOKENIZER.eos_token
+        eos_token = tokenizer.eos_token
 
         if self.categoric:  # generate "Entailment", "None"
-            target = ASSIN.TOKENIZER.encode(text=f"{data['entailment']}{eos_token}",
-                                            max_length=5,
-                                            pad_to_max_length=True,
-                                            return_tensors='pt').squeeze()
+            targets = [f"{data['entailment']}{eos_token}" for data in self.data]
+            original_number = torch.tensor([ASSIN.CLASSESv2.index(data["entailment"]) for data in self.data],
+                                           dtype=torch.long)
         else:
-            target = ASSIN.TOKENIZER.encode(text=f'{data["similarity"]}{eos_token}',
-                                            max_length=5,
-                                            pad_to_max_length=True,
-                                            return_tensors='pt').squeeze()
+            targets = [f'{data["similarity"]}{eos_token}' for data in self.data]
+            original_number = torch.tensor([data["similarity"] for data in self.data], dtype=torch.float)
+
+        # eos tokens are added explicitly, as the original slow tokenizer did not add them
+        target = tokenizer(text=targets,
+                           add_special_tokens=False,
+                           max_length=5,
+                           padding="max_length",
+                           truncation=True,
+                           return_tensors='pt')["input_ids"]
+
+        source = tokenizer(text=[f"ASSIN sentence1: {data['pair'][0]} {eos_token}" for data in self.data],
+                           text_pair=[f"sentence2: {data['pair'][1]} {eos_token}" for data in self.data],
+                           add_special_tokens=False,
+                           max_length=self.seq_len,
+                           padding="max_length",
+                           truncation=True,
+                           return_tensors='pt')
+
+        return source["input_ids"], source["attention_mask"], target, original_number
 
-        if self.categoric:
-            original_number = torch.Tensor([ASSIN.CLASSESv2.index(data["entailment"])]).long().squeeze()
-        else:
-            original_number = torch.Tensor([data["similarity"]]).float().squeeze()
+    def __len__(self):
+        return len(self.data)
 
-        source = ASSIN.TOKENIZER.encode_plus(text=f"ASSIN sentence1: {pair[0]} {eos_token}",
-                                             text_pair=f"sentence2: {pair[1]} {eos_token}",
-                                             max_length=self.seq_len,
-                                             pad_to_max_length=True,
-                                             return_tensors='pt')
+    def __getitem__(self, i: int):
+        '''
+        Slices the pre-tokenized tensors.
 
-        return source["input_ids"].squeeze(), source["attention_mask"].squeeze(), target, original_number
+        returns: input_ids, attention_mask, target (encoded), original_number
+        '''
+        return tuple(tensor[i] for tensor in self.tensors)
 
-    def get_dataloader(self, batch_size: int, shuffle: bool):
-        return DataLoader(self, batch_size=batch_size, shuffle=shuffle,
-                          num_workers=4)
+    def get_dataloader(self, batch_size: int, shuffle: bool, dynamic_padding: bool = False,
+                       num_workers: int = min(cpu_count(), 8), pin_memory: bool = True):
+        '''
+        dynamic_padding: batch examples of similar length and pad only to the longest one in each batch
+        num_workers: loading processes, kept alive between epochs
+        pin_memory: allows asynchronous host to GPU copies
+        '''
+        kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+        if num_workers > 0 and "persistent_workers" in inspect.signature(DataLoader).parameters:  # PyTorch >= 1.7
+            kwargs.update({"persistent_workers": True, "prefetch_factor": 4})
+
+        if dynamic_padding:
+            lengths = self.tensors[1].sum(dim=1).tolist()
+            return DataLoader(self, batch_sampler=BucketBatchSampler(lengths, batch_size, shuffle),
+                              collate_fn=trim_collate, **kwargs)
+        else:
+            return DataLoader(self, batch_size=batch_size, shuffle=shuffle, **kwargs)
 
 
 if __name__ == "__main__":
@@ -4,7 +4,10 @@ This is the main script for fine-tuning in ASSIN2
 '''
 # Standard Libraries
 import os
+import re
+import contextlib
 import argparse
+import inspect
 import time
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -13,16 +16,15 @@ from multiprocessing import cpu_count
 
 # External Libraries
 import torch
-import numpy as np
 from tqdm import tqdm
 from torch import nn
+from torch.nn import functional as F
 from radam import RAdam
-from scipy.stats import pearsonr
-from assin_dataset import ASSIN, get_custom_vocab
+from assin_dataset import ASSIN, get_tokenizer
 
 # PyTorch Lightning and Transformers
+# transformers is only imported where models and tokenizers are built, spawned dataloader workers re-import this module
 import pytorch_lightning as pl
-from transformers import T5Model, PretrainedConfig, T5ForConditionalGeneration, T5Tokenizer
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning import Trainer, seed_everything
@@ -37,9 +39,35 @@ logging.info(f"PyTorch v{torch.__version__}. Recommended >= 1.5.1.")
 logging.info(f"Imports loaded succesfully. Number of CPU cores: {cpu_count()}. CUDA available: {torch.cuda.is_available()}.")
 
 CONFIG_PATH = "T5_configs_json"
+NUMBER_REGEX = re.compile(r'[-+]?\d*\.?\d+')
+
+# Architectures, any other name is a similarity model with a linear layer
+MLP, CATEGORIC, GEN, CATEGORIC_GEN, SIMILARITY = range(5)
+ARCHITECTURES = {"mlp": MLP, "categoric": CATEGORIC, "gen": GEN, "categoric_gen": CATEGORIC_GEN}
+
+
+def get_precision(precision):
+    '''
+    Resolves the --precision argument to "bf16", 16 or 32.
+    PL only supports 16 and 32 bit precision, bf16 is applied with autocast inside the model.
+    bf16 falls back to 32 on GPUs without bf16 support (pre-Ampere), as T5 activations can overflow in fp16.
+    16 is only used when explicitly asked for.
+    '''
+    if precision == "bf16":
+        bf16_supported = torch.cuda.is_available() and getattr(torch.cuda, "is_bf16_supported", lambda: False)()
+        if bf16_supported:
+            return "bf16"
+        else:
+            logging.warning("bf16 not supported by this device, falling back to 32.")
+            return 32
+
+    return int(precision)
 
 
 class PearsonCalculator():
+    '''
+    Keeps predictions and targets on their device, synchronizing only once when calculating.
+    '''
     def __init__(self):
         self.y_hat = []
         self.y = []
@@ -48,15 +76,21 @@ class PearsonCalculator():
         assert len(y_hat.shape) == 1
         assert len(y.shape) == 1
 
-        self.y_hat = np.concatenate((self.y_hat, y_hat))
-        self.y = np.concatenate((self.y, y))
+        # Concatenated only once, in calculate_pearson
+        self.y_hat.append(y_hat.detach())
+        self.y.append(y.detach())
 
     def calculate_pearson(self):
-        if len(self.y) < 2:
+        if sum(len(y) for y in self.y) < 2:
             logging.warning("Pearson does not have enough samples, returning nan")
             ret = float('nan')
         else:
-            ret = pearsonr(self.y, self.y_hat)[0]
+            # Same as scipy's pearsonr, computed in fp32 where the tensors are
+            y_hat = torch.cat(self.y_hat).float()
+            y = torch.cat(self.y).float()
+            y_hat = y_hat - y_hat.mean()
+            y = y - y.mean()
+            ret = ((y_hat * y).sum() / (y_hat.norm() * y.norm())).item()
 
         self.y_hat = []
         self.y = []
@@ -75,57 +109,143 @@ class NONLinearInput(nn.Module):
         return 1 + self.net(x.float()).sigmoid() * 4
 
 
+@torch.jit.script
+def masked_mean(x, attention_mask):
+    '''
+    Mean over the sequence dimension, ignoring padding.
+    Scripted into a single graph, heads stay eager so Lightning can hook them.
+    '''
+    mask = attention_mask.unsqueeze(-1).to(x.dtype)
+    return (x * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+class SimilarityHead(nn.Linear):
+    '''
+    Linear layer over the sequence mean, with output between 1 and 5.
+    Subclasses nn.Linear to keep the same checkpoint keys as the original linear layer.
+    '''
+    def __init__(self, nin):
+        super().__init__(nin, 1)
+
+    def forward(self, x, attention_mask):
+        return 1 + F.linear(masked_mean(x, attention_mask), self.weight, self.bias).sigmoid() * 4
+
+
+class CategoricHead(nn.Linear):
+    '''
+    Linear layer over the sequence mean, returning class logits.
+    '''
+    def __init__(self, nin, nout):
+        super().__init__(nin, nout)
+
+    def forward(self, x, attention_mask):
+        return F.linear(masked_mean(x, attention_mask), self.weight, self.bias)
+
+
 class T5ASSIN(pl.LightningModule):
     def __init__(self, hparams):
         super().__init__()
 
         self.hparams = hparams
-        if self.hparams.vocab_name == "custom":
-            self.tokenizer = get_custom_vocab()
-        else:
-            self.tokenizer = T5Tokenizer.from_pretrained(self.hparams.vocab_name)
 
-        if "small" in self.hparams.model_name.split('-'):
+        # Resolved once, avoiding string comparisons every step
+        self._arch = ARCHITECTURES.get(self.hparams.architecture, SIMILARITY)
+        self._is_gen = self._arch in (GEN, CATEGORIC_GEN)
+        self._is_categoric = self._arch in (CATEGORIC, CATEGORIC_GEN)
+        # Checkpoints from before encoder pooling have no pooling hparam and keep pooling the decoder output
+        self._decoder_pooling = getattr(self.hparams, "pooling", "decoder") == "decoder"
+
+        self.tokenizer = get_tokenizer(self.hparams.vocab_name)
+
+        name_parts = set(self.hparams.model_name.split('-'))
+        if "small" in name_parts:
             self.size = "small"
-        elif "base" in self.hparams.model_name.split('-'):
+        elif "base" in name_parts:
             self.size = "base"
-        elif "large" in self.hparams.model_name.split('-'):
+        elif "large" in name_parts:
             self.size = "large"
         else:
             raise ValueError("Couldn't detect model size from model_name.")
 
-        if self.hparams.model_name[:2] == "pt":
+        from transformers import T5Config, T5Model, T5ForConditionalGeneration
+        try:
+            from transformers import T5EncoderModel
+        except ImportError:  # transformers < 4.1, the decoder is dropped after loading instead
+            T5EncoderModel = None
+
+        # Encoder pooling doesn't need the decoder, avoid keeping it in memory and in the optimizer
+        encoder_only = not self._is_gen and not self._decoder_pooling
+        if self._is_gen:
+            model_class = T5ForConditionalGeneration
+        elif encoder_only and T5EncoderModel is not None:
+            model_class = T5EncoderModel
+        else:
+            model_class = T5Model
+
+        if self.hparams.model_name.startswith("pt"):
             logging.info("Initializing from PTT5 checkpoint...")
             config, state_dict = self.get_ptt5()
-            if self.hparams.architecture == "gen" or self.hparams.architecture == "categoric_gen":
-                self.t5 = T5ForConditionalGeneration.from_pretrained(pretrained_model_name_or_path=None,
-                                                                     config=config,
-                                                                     state_dict=state_dict)
-            else:
-                self.t5 = T5Model.from_pretrained(pretrained_model_name_or_path=None,
-                                                  config=config,
-                                                  state_dict=state_dict)
+            pretrained_name = None
         else:
             logging.info("Initializing from T5 checkpoint...")
-            if self.hparams.architecture == "gen" or self.hparams.architecture == "categoric_gen":
-                self.t5 = T5ForConditionalGeneration.from_pretrained(self.hparams.model_name)
+            config = T5Config.from_pretrained(self.hparams.model_name)
+            state_dict = None
+            pretrained_name = self.hparams.model_name
+
+        # Recompute activations in backward, trading compute for memory and allowing bigger batch sizes.
+        # transformers >= 4.11 enables it with a method, older 4.x releases through the config
+        checkpointing = self._arch != MLP
+        checkpointing_method = hasattr(model_class, "gradient_checkpointing_enable")
+        if checkpointing and not checkpointing_method:
+            config.gradient_checkpointing = True
+
+        self.t5 = model_class.from_pretrained(pretrained_model_name_or_path=pretrained_name,
+                                              config=config,
+                                              state_dict=state_dict)
+
+        if encoder_only and model_class is T5Model:
+            del self.t5.decoder
+
+        if checkpointing and checkpointing_method:
+            self.t5.gradient_checkpointing_enable()
+
+        # Kernel fusion for the encoder, compiled in place to keep checkpoint keys. Batch lengths vary with dynamic padding,
+        # hence dynamic shapes and no CUDA graphs, which would record a graph and memory pool per length.
+        # gen architectures call generate() and stay eager
+        if self._arch in (CATEGORIC, SIMILARITY) and not self.hparams.debug:
+            if hasattr(self.t5.encoder, "compile"):  # PyTorch >= 2.2
+                self.t5.encoder.compile(dynamic=True)
+            elif hasattr(torch, "compile"):  # PyTorch 2.0 and 2.1, compiling forward also keeps the keys
+                self.t5.encoder.forward = torch.compile(self.t5.encoder.forward, dynamic=True)
             else:
-                self.t5 = T5Model.from_pretrained(self.hparams.model_name)
+                logging.warning("Installed PyTorch does not support torch.compile, running eagerly.")
 
         D = self.t5.config.d_model
 
-        if self.hparams.architecture == "mlp":
+        if self._arch == MLP:
             # Replace T5 with a simple nonlinear input
             self.t5 = NONLinearInput(self.hparams.seq_len, D)
 
-        if self.hparams.architecture != "gen" and self.hparams.architecture != "categoric_gen":
-            if self.hparams.architecture == "categoric":
+        if not self._is_gen:
+            if self._arch == MLP:
+                self.linear = nn.Linear(D, 1)
+            elif self._arch == CATEGORIC:
                 assert self.hparams.nout != 1, "Categoric mode with 1 nout doesn't work with CrossEntropyLoss"
-                self.linear = nn.Linear(D, self.hparams.nout)
+                self.linear = CategoricHead(D, self.hparams.nout)
             else:
-                self.linear = nn.Linear(D, 1)
+                self.linear = SimilarityHead(D)
+
+        # Bound once, steps call it directly without going through forward's unpacking and dispatch
+        if self._arch == MLP:
+            self._forward_impl = self._forward_mlp
+        elif self._is_gen:
+            self._forward_impl = self._forward_gen
+        elif self._decoder_pooling:
+            self._forward_impl = self._forward_decoder_pooling
+        else:
+            self._forward_impl = self._forward_linear
 
-        if self.hparams.architecture == "categoric" or self.hparams.architecture == "categoric_gen":
+        if self._is_categoric:
             self.loss = nn.CrossEntropyLoss()
         else:
             self.loss = nn.MSELoss()
@@ -147,42 +267,77 @@ class T5ASSIN(pl.LightningModule):
         logging.info(f"Loading initial ckpt from {ckpt_path}")
         logging.info(f"Loading config from {config_path}")
 
+        from transformers import PretrainedConfig
         config = PretrainedConfig.from_json_file(config_path)
-        state_dict = torch.load(ckpt_path)
+        # Memory-map the weights straight from disk instead of copying them to host RAM (PyTorch >= 2.1)
+        if "mmap" in inspect.signature(torch.load).parameters:
+            try:
+                state_dict = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+            except RuntimeError:  # legacy (non zipfile) checkpoints can't be memory-mapped
+                state_dict = torch.load(ckpt_path, map_location="cpu", weights_only=True)
+        else:
+            state_dict = torch.load(ckpt_path, map_location="cpu")
         return config, state_dict
 
     def forward(self, x):
         input_ids, attention_mask, y, original_number = x
 
-        if self.hparams.architecture == "mlp":
-            return self.linear(self.t5(input_ids))
-        elif self.hparams.architecture == "categoric":
-            return self.linear(self.t5(input_ids=input_ids,
-                                       decoder_input_ids=input_ids,
-                                       attention_mask=attention_mask)[0].mean(dim=1))
-        elif self.hparams.architecture == "gen" or self.hparams.architecture == "categoric_gen":
-            if self.training:
-                return self.t5(input_ids=input_ids,
-                               attention_mask=attention_mask,
-                               lm_labels=y)[0]
-            else:
-                return self.t5.generate(input_ids=input_ids,
-                                        attention_mask=attention_mask,
-                                        max_length=5,  # 5 enough to represent numbers / "Entailment"
-                                        do_sample=False)
-        else:  # similarity with linear layer
-            return 1 + self.linear(self.t5(input_ids=input_ids,
-                                           decoder_input_ids=input_ids,
-                                           attention_mask=attention_mask)[0].mean(dim=1)).sigmoid() * 4
+        return self._forward_impl(input_ids, attention_mask, y)
+
+    def _forward_mlp(self, input_ids, attention_mask, y):
+        return self.linear(self.t5(input_ids))
+
+    def _forward_linear(self, input_ids, attention_mask, y):
+        # Categoric or similarity with linear layer. Only the encoder is needed to pool a sentence pair representation
+        return self.linear(self.t5.encoder(input_ids=input_ids, attention_mask=attention_mask)[0], attention_mask)
+
+    def _forward_decoder_pooling(self, input_ids, attention_mask, y):
+        # Original linear architectures: mean over every decoder position, including padding
+        return self.linear(self.t5(input_ids=input_ids,
+                                   decoder_input_ids=input_ids,
+                                   attention_mask=attention_mask)[0], torch.ones_like(attention_mask))
+
+    def _forward_gen(self, input_ids, attention_mask, y):
+        if self.training:
+            return self.t5(input_ids=input_ids,
+                           attention_mask=attention_mask,
+                           lm_labels=y)[0]
+        else:
+            return self.t5.generate(input_ids=input_ids,
+                                    attention_mask=attention_mask,
+                                    max_length=5,  # 5 enough to represent numbers / "Entailment"
+                                    do_sample=False)
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx=0):
+        # Dataloaders pin memory, so copies can overlap with computation
+        return tuple(tensor.to(device, non_blocking=True) for tensor in batch)
+
+    def pad_after_eos(self, tokens):
+        '''
+        Replaces everything after the first eos token with padding.
+        '''
+        eos = (tokens == self.tokenizer.eos_token_id).long()
+        after_eos = (eos.cumsum(dim=1) - eos) > 0
+        return tokens.masked_fill(after_eos, self.tokenizer.pad_token_id)
+
+    def autocast(self):
+        '''
+        bf16 autocast, since PL only handles 16 bit mixed precision with fp16.
+        '''
+        if self.hparams.precision == "bf16":
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        else:
+            return contextlib.nullcontext()
 
     def training_step(self, batch, batch_idx):
         input_ids, attention_mask, y, original_number = batch
 
-        if self.hparams.architecture == "gen" or self.hparams.architecture == "categoric_gen":
-            loss = self(batch)
-        else:
-            y_hat = self(batch).squeeze(-1)
-            loss = self.loss(y_hat, original_number)
+        with self.autocast():
+            if self._is_gen:
+                loss = self._forward_impl(input_ids, attention_mask, y)
+            else:
+                y_hat = self._forward_impl(input_ids, attention_mask, y).squeeze(-1)
+                loss = self.loss(y_hat, original_number)
 
         ret_dict = {'loss': loss}
 
@@ -190,45 +345,41 @@ class T5ASSIN(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         input_ids, attention_mask, y, original_number = batch
-        if self.hparams.architecture == "gen":
-            pred_tokens = self(batch)
-
-            # Make a [batch, number] representation
-            string_y_hat = [self.tokenizer.decode(pred) for pred in pred_tokens]
-            y_hat = torch.zeros_like(original_number)
-            for n, phrase in enumerate(string_y_hat):
-                for word in phrase.split():
-                    try:
-                        number = float(word)
-                        if number > 5.0:
-                            number = 5.0
-                        elif number < 1.0:
-                            number = 1.0
-                        y_hat[n] = number
-                        break
-                    except ValueError:
-                        pass
-
-            loss = self.loss(y_hat, original_number)
-            ret_dict = {'loss': loss}
-        elif self.hparams.architecture == "categoric_gen":  # not able to calculate loss in validation using categoric generation
-            pred_tokens = self(batch)
-            string_y_hat = [self.tokenizer.decode(pred).strip() for pred in pred_tokens]
-            string_y = [self.tokenizer.decode(target_y).strip() for target_y in y]
-
-            acc = torch.Tensor([str_y_hat == str_y for str_y_hat, str_y in zip(string_y_hat, string_y)]).float().mean()
-
-            ret_dict = {'acc': acc}
-        elif self.hparams.architecture == "categoric":  # cross entropy loss and accuracy are returned
-            y_hat = self(batch)
-            loss = self.loss(y_hat, original_number)
-            acc = (y_hat.argmax(dim=1).eq(original_number)).float().mean()
-            ret_dict = {'loss': loss, 'acc': acc}
-        else:  # default, linear layer activation
-            y_hat = self(batch).squeeze(-1)
-            loss = self.loss(y_hat, original_number)
-            self.pearson_calculator(y_hat.detach().cpu().numpy(), original_number.cpu().numpy())
-            ret_dict = {'loss': loss}
+
+        with self.autocast():
+            if self._arch == GEN:
+                pred_tokens = self._forward_impl(input_ids, attention_mask, y)
+
+                # Make a [batch, number] representation, using the first number found in each prediction
+                string_y_hat = self.tokenizer.batch_decode(pred_tokens, skip_special_tokens=True)
+                matches = [NUMBER_REGEX.search(phrase) for phrase in string_y_hat]
+                y_hat = torch.tensor([float(match.group()) if match is not None else 0.0 for match in matches],
+                                     dtype=original_number.dtype, device=original_number.device).clamp_(1.0, 5.0)
+
+                loss = self.loss(y_hat, original_number)
+                ret_dict = {'loss': loss}
+            elif self._arch == CATEGORIC_GEN:  # not able to calculate loss in validation using categoric generation
+                # Compare token ids directly, dropping the decoder start token from predictions
+                pred_tokens = self.pad_after_eos(self._forward_impl(input_ids, attention_mask, y)[:, 1:])
+                y = self.pad_after_eos(y)
+
+                length = max(pred_tokens.shape[1], y.shape[1])
+                pred_tokens = F.pad(pred_tokens, (0, length - pred_tokens.shape[1]), value=self.tokenizer.pad_token_id)
+                y = F.pad(y, (0, length - y.shape[1]), value=self.tokenizer.pad_token_id)
+
+                acc = (pred_tokens == y).all(dim=1).float().mean()
+
+                ret_dict = {'acc': acc}
+            elif self._arch == CATEGORIC:  # cross entropy loss and accuracy are returned
+                y_hat = self._forward_impl(input_ids, attention_mask, y)
+                loss = self.loss(y_hat, original_number)
+                acc = (y_hat.argmax(dim=1).eq(original_number)).float().mean()
+                ret_dict = {'loss': loss, 'acc': acc}
+            else:  # default, linear layer activation
+                y_hat = self._forward_impl(input_ids, attention_mask, y).squeeze(-1)
+                loss = self.loss(y_hat, original_number)
+                self.pearson_calculator(y_hat, original_number)
+                ret_dict = {'loss': loss}
 
         return ret_dict
 
@@ -244,13 +395,13 @@ class T5ASSIN(pl.LightningModule):
     def validation_epoch_end(self, outputs):
         name = "val_"
 
-        if self.hparams.architecture == "categoric":  # acc and loss
+        if self._arch == CATEGORIC:  # acc and loss
             loss = torch.stack([x['loss'] for x in outputs]).mean()
             acc = torch.stack([x['acc'] for x in outputs]).mean()
 
             logs = {name + "loss": loss, name + "acc": acc}
             return {name + 'loss': loss, name + 'acc': acc, 'log': logs, 'progress_bar': logs}
-        elif self.hparams.architecture == "categoric_gen":  # only acc
+        elif self._arch == CATEGORIC_GEN:  # only acc
             acc = torch.stack([x['acc'] for x in outputs]).mean()
 
             logs = {name + "acc": acc}
@@ -263,7 +414,26 @@ class T5ASSIN(pl.LightningModule):
             return {name + 'loss': loss, 'log': logs, 'progress_bar': logs}
 
     def configure_optimizers(self):
-        return RAdam(self.parameters(), lr=self.hparams.lr)
+        # AdamW variants default to 0.01, keep RAdam's 0 unless asked. Older checkpoints have no weight_decay hparam
+        weight_decay = getattr(self.hparams, "weight_decay", 0.0)
+
+        if self.hparams.optimizer == "radam":
+            return RAdam(self.parameters(), lr=self.hparams.lr, weight_decay=weight_decay)
+        elif self.hparams.optimizer == "adamw_8bit":
+            # 8-bit optimizer states, only needed for big models
+            import bitsandbytes as bnb
+            return bnb.optim.AdamW8bit(self.parameters(), lr=self.hparams.lr, weight_decay=weight_decay)
+        else:
+            # Fused kernel updates all parameters in a single launch, requires CUDA and PyTorch >= 2.0
+            fused = torch.cuda.is_available() and "fused" in inspect.signature(torch.optim.AdamW).parameters
+            if fused:
+                return torch.optim.AdamW(self.parameters(), lr=self.hparams.lr, weight_decay=weight_decay, fused=True)
+            else:
+                return torch.optim.AdamW(self.parameters(), lr=self.hparams.lr, weight_decay=weight_decay)
+
+    def _use_dynamic_padding(self):
+        # mlp input layer needs fixed seq_len inputs, decoder pooling averages over the fixed padding
+        return self._arch != MLP and (self._is_gen or not self._decoder_pooling)
 
     def train_dataloader(self):
         if self.hparams.overfit_pct > 0:
@@ -272,13 +442,15 @@ class T5ASSIN(pl.LightningModule):
         else:
             shuffle = True
         dataset = ASSIN(mode="train", version=self.hparams.version, seq_len=self.hparams.seq_len,
-                        vocab_name=self.hparams.vocab_name, categoric="categoric" in self.hparams.architecture)
-        return dataset.get_dataloader(batch_size=self.hparams.bs, shuffle=shuffle)
+                        vocab_name=self.hparams.vocab_name, categoric=self._is_categoric)
+        return dataset.get_dataloader(batch_size=self.hparams.bs, shuffle=shuffle,
+                                      dynamic_padding=self._use_dynamic_padding())
 
     def val_dataloader(self):
         dataset = ASSIN(mode="validation", version=self.hparams.version, seq_len=self.hparams.seq_len,
-                        vocab_name=self.hparams.vocab_name, categoric="categoric" in self.hparams.architecture)
-        return dataset.get_dataloader(batch_size=self.hparams.bs, shuffle=False)
+                        vocab_name=self.hparams.vocab_name, categoric=self._is_categoric)
+        return dataset.get_dataloader(batch_size=self.hparams.bs, shuffle=False,
+                                      dynamic_padding=self._use_dynamic_padding())
 
 
 if __name__ == "__main__":
@@ -294,10 +466,16 @@ if __name__ == "__main__":
     parser.add_argument('--seq_len', type=int, default=128)
     parser.add_argument('--version', type=str, default='v2')
     parser.add_argument('--lr', type=float, default=0.0001)
-    parser.add_argument('--precision', type=int, default=32)
+    parser.add_argument('--weight_decay', type=float, default=0.0)
+    parser.add_argument('--optimizer', type=str, default="adamw", choices=["adamw", "adamw_8bit", "radam"],
+                        help="adamw uses the fused kernel when available. radam reproduces past experiments.")
+    parser.add_argument('--precision', type=str, default="bf16", choices=["bf16", "16", "32"])
     parser.add_argument('--overfit_pct', type=float, default=0)
     parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--deterministic', action="store_true", help="Bit exact runs, disables cudnn benchmark and TF32.")
     parser.add_argument('--nout', type=int, default=1)
+    parser.add_argument('--pooling', type=str, default="encoder", choices=["encoder", "decoder"],
+                        help="Linear architectures pool the encoder output, or the decoder output as in the original experiments.")
     parser.add_argument('--patience', type=int, default=5)
     parser.add_argument('--gpu', type=int, default=1)
     parser.add_argument('--checkpoint_path', type=str, help="Where are pre-trained checkpoints from PTT5.")
@@ -323,6 +501,9 @@ if __name__ == "__main__":
     model_folder = os.path.join(model_path, experiment_name)
     os.makedirs(model_folder, exist_ok=True)
 
+    # bf16 is applied by the model, the Trainer runs it as 32 bit
+    hparams.precision = get_precision(hparams.precision)
+
     # Instantiate model
     model = T5ASSIN(hparams)
 
@@ -353,7 +534,7 @@ if __name__ == "__main__":
 
     # PL Trainer initialization
     trainer = Trainer(gpus=hparams.gpu,
-                      precision=hparams.precision,
+                      precision=32 if hparams.precision == "bf16" else hparams.precision,
                       checkpoint_callback=checkpoint_callback,
                       early_stop_callback=early_stop_callback,
                       logger=logger,
@@ -362,12 +543,18 @@ if __name__ == "__main__":
                       fast_dev_run=hparams.debug,
                       overfit_batches=hparams.overfit_pct,
                       progress_bar_refresh_rate=1,
-                      deterministic=True
+                      deterministic=hparams.deterministic
                       )
 
     seed_everything(4321)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if hparams.deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # Faster kernels and TF32 tensor cores on Ampere+, at the cost of bit exact reproducibility
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     logging.info("Training will start in 3 seconds! CTRL-C to cancel.")
     try: